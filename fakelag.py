@@ -0,0 +1,1239 @@
+#!/usr/bin/env python3
+"""fakelag: a UDP proxy that simulates latency, jitter and packet loss.
+
+Run it between a game client and a server to test online co-op (e.g.
+Unity netcode) under degraded network conditions:
+
+    python fakelag.py --listen 0.0.0.0:7777 --remote 203.0.113.5:7777 \\
+        --latency 80 --jitter 20 --loss 0.02
+
+then point the client at the proxy's listen port instead of the server.
+"""
+
+import argparse
+import collections
+import ctypes
+import errno
+import heapq
+import itertools
+import logging
+import multiprocessing
+import os
+import random
+import selectors
+import socket
+import struct
+import sys
+import threading
+import time
+from dataclasses import dataclass
+
+try:
+    import numpy
+except ImportError:  # numpy is optional; the stdlib RNG works fine
+    numpy = None
+
+
+@dataclass(slots=True)
+class LagConfig:
+    """Network conditions applied to each forwarded packet."""
+
+    latency_ms: float = 100.0
+    jitter_ms: float = 0.0
+    loss: float = 0.0  # drop probability in [0, 1] (iid model)
+    # Loss model: "iid" draws an independent Bernoulli per packet;
+    # "ge" runs a Gilbert-Elliott two-state Markov chain, which
+    # produces the bursty losses real links show ([DOC 2]; tc netem
+    # exposes the same model as "loss gemodel").
+    loss_model: str = "iid"
+    ge_p: float = 0.05  # Good -> Bad transition probability
+    ge_r: float = 0.5  # Bad -> Good transition probability
+    ge_loss_good: float = 0.0  # drop probability while in Good
+    ge_loss_bad: float = 1.0  # drop probability while in Bad
+    # With probability `reorder`, a packet skips the latency/jitter
+    # delay and is sent immediately, overtaking in-flight packets
+    # (netem's reorder semantics).  `preserve_order` instead clamps
+    # each deadline to never precede the previous one per direction,
+    # so jitter can stretch gaps but never reorder; it wins over
+    # `reorder` if both are set.
+    reorder: float = 0.0
+    preserve_order: bool = False
+
+
+logger = logging.getLogger("fakelag")
+
+
+if sys.platform == "linux":
+    try:
+        _libc = ctypes.CDLL(None, use_errno=True)
+        _libc.recvmmsg
+        _libc.sendmmsg
+    except (OSError, AttributeError):
+        _libc = None
+else:
+    _libc = None
+
+
+class _iovec(ctypes.Structure):
+    _fields_ = [("iov_base", ctypes.c_void_p), ("iov_len", ctypes.c_size_t)]
+
+
+class _msghdr(ctypes.Structure):
+    _fields_ = [
+        ("msg_name", ctypes.c_void_p),
+        ("msg_namelen", ctypes.c_uint),
+        ("msg_iov", ctypes.POINTER(_iovec)),
+        ("msg_iovlen", ctypes.c_size_t),
+        ("msg_control", ctypes.c_void_p),
+        ("msg_controllen", ctypes.c_size_t),
+        ("msg_flags", ctypes.c_int),
+    ]
+
+
+class _mmsghdr(ctypes.Structure):
+    _fields_ = [("msg_hdr", _msghdr), ("msg_len", ctypes.c_uint)]
+
+
+class _timespec(ctypes.Structure):
+    _fields_ = [("tv_sec", ctypes.c_long), ("tv_nsec", ctypes.c_long)]
+
+
+class _itimerspec(ctypes.Structure):
+    _fields_ = [("it_interval", _timespec), ("it_value", _timespec)]
+
+
+# timerfd_create / timerfd_settime constants (linux/timerfd.h)
+_CLOCK_MONOTONIC = 1
+_TFD_NONBLOCK = 0o4000
+_TFD_TIMER_ABSTIME = 1
+
+# Linux socket options the socket module does not expose.
+_SO_BUSY_POLL = 46  # asm-generic/socket.h
+_IP_MTU_DISCOVER = 10  # linux/in.h
+_IP_PMTUDISC_DO = 2  # always set DF, never fragment
+
+
+class MmsgBatch:
+    """Batched UDP I/O over Linux ``recvmmsg(2)``/``sendmmsg(2)``.
+
+    One recvfrom + one sendto per packet means two kernel crossings per
+    packet; these syscalls move up to BATCH datagrams per crossing.
+    Buffers, iovecs and headers are allocated once and reused.  Use one
+    instance per socket/direction (the arrays are not re-entrant).
+    Only built when libc exposes the calls; callers fall back to the
+    one-datagram socket methods elsewhere.
+    """
+
+    BATCH = 64
+    BUF_SIZE = 65535
+    _SOCKADDR_LEN = 16  # sizeof(struct sockaddr_in)
+    MSG_DONTWAIT = 0x40
+
+    def __init__(self, with_names):
+        n = self.BATCH
+        self._bufs = [ctypes.create_string_buffer(self.BUF_SIZE) for _ in range(n)]
+        self._views = [memoryview(b) for b in self._bufs]
+        self._iovecs = (_iovec * n)()
+        self._hdrs = (_mmsghdr * n)()
+        self._names = (ctypes.c_char * self._SOCKADDR_LEN * n)() if with_names else None
+        for i in range(n):
+            iov = self._iovecs[i]
+            iov.iov_base = ctypes.cast(self._bufs[i], ctypes.c_void_p)
+            iov.iov_len = self.BUF_SIZE
+            hdr = self._hdrs[i].msg_hdr
+            hdr.msg_iov = ctypes.pointer(self._iovecs[i])
+            hdr.msg_iovlen = 1
+            if with_names:
+                hdr.msg_name = ctypes.cast(
+                    ctypes.byref(self._names[i]), ctypes.c_void_p
+                )
+                hdr.msg_namelen = self._SOCKADDR_LEN
+
+    def recv(self, fd):
+        """Return up to BATCH datagrams ready on ``fd``.
+
+        Each entry is ``(view, addr)`` when built with names, else just
+        ``view``, where ``view`` is a memoryview into this batch's own
+        receive buffer -- valid only until the next :meth:`recv` call,
+        so callers must send or copy before recv'ing again.  Returns
+        ``[]`` when the socket would block.
+        """
+        names = self._names
+        if names is not None:
+            for i in range(self.BATCH):
+                # The kernel overwrites namelen with the actual length.
+                self._hdrs[i].msg_hdr.msg_namelen = self._SOCKADDR_LEN
+        n = _libc.recvmmsg(fd, self._hdrs, self.BATCH, self.MSG_DONTWAIT, None)
+        if n < 0:
+            err = ctypes.get_errno()
+            if err in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                return []
+            raise OSError(err, os.strerror(err))
+        out = []
+        for i in range(n):
+            view = self._views[i][: self._hdrs[i].msg_len]
+            if names is None:
+                out.append(view)
+            else:
+                raw = bytes(names[i])
+                (port,) = struct.unpack_from("!H", raw, 2)
+                out.append((view, (socket.inet_ntoa(raw[4:8]), port)))
+        return out
+
+    def send(self, fd, packets):
+        """Send ``((buf, length), sockaddr)`` entries from ``fd``, batched.
+
+        ``sockaddr`` is a pre-packed ``struct sockaddr_in`` (see
+        :func:`pack_sockaddr`), so addressing a packet is one memmove
+        instead of re-encoding host/port each time.  Packets that
+        cannot be sent without blocking are dropped, which is the right
+        behaviour for a UDP lag simulator.
+        """
+        names = self._names
+        idx = 0
+        total = len(packets)
+        while idx < total:
+            count = min(self.BATCH, total - idx)
+            for i in range(count):
+                (buf, length), sockaddr = packets[idx + i]
+                ctypes.memmove(
+                    self._bufs[i], (ctypes.c_char * length).from_buffer(buf), length
+                )
+                self._iovecs[i].iov_len = length
+                ctypes.memmove(names[i], sockaddr, self._SOCKADDR_LEN)
+                self._hdrs[i].msg_hdr.msg_namelen = self._SOCKADDR_LEN
+            sent = self._sendmmsg(fd, count)
+            if sent < 0:
+                break
+            idx += sent
+        self._restore_iovecs(total)
+
+    def send_connected(self, fd, datas):
+        """Send ``(buf, length)`` payloads from a connected ``fd``, batched."""
+        idx = 0
+        total = len(datas)
+        while idx < total:
+            count = min(self.BATCH, total - idx)
+            for i in range(count):
+                buf, length = datas[idx + i]
+                ctypes.memmove(
+                    self._bufs[i], (ctypes.c_char * length).from_buffer(buf), length
+                )
+                self._iovecs[i].iov_len = length
+            sent = self._sendmmsg(fd, count)
+            if sent < 0:
+                break
+            idx += sent
+        self._restore_iovecs(total)
+
+    def _sendmmsg(self, fd, count):
+        """One sendmmsg attempt; -1 means give up on the batch."""
+        while True:
+            n = _libc.sendmmsg(fd, self._hdrs, count, self.MSG_DONTWAIT)
+            if n >= 0:
+                return n
+            err = ctypes.get_errno()
+            if err == errno.EINTR:
+                continue
+            if err in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return -1
+            raise OSError(err, os.strerror(err))
+
+    def _restore_iovecs(self, used):
+        # Restore full-size iovecs for any recv user of this batch.
+        for i in range(min(self.BATCH, used)):
+            self._iovecs[i].iov_len = self.BUF_SIZE
+
+
+class RandomBatch:
+    """Uniform [0, 1) draws, refilled a few thousand at a time.
+
+    Refilling in bulk (vectorized through NumPy when it happens to be
+    installed) keeps per-call RNG overhead out of the per-packet path;
+    consuming a draw is just a list index.  Not thread-safe: each
+    consumer thread should own its instance.
+    """
+
+    BATCH = 4096
+
+    def __init__(self):
+        self._rng = random.Random() if numpy is None else numpy.random.default_rng()
+        self._values = []
+        self._index = 0
+        self._gauss_values = []
+        self._gauss_index = 0
+        self._u32_values = []
+        self._u32_index = 0
+
+    def next(self):
+        i = self._index
+        if i >= len(self._values):
+            self._refill()
+            i = 0
+        self._index = i + 1
+        return self._values[i]
+
+    def next_gauss(self):
+        """Standard-normal draw, batched the same way as :meth:`next`."""
+        i = self._gauss_index
+        if i >= len(self._gauss_values):
+            self._refill_gauss()
+            i = 0
+        self._gauss_index = i + 1
+        return self._gauss_values[i]
+
+    def next_u32(self):
+        """Uniform 32-bit integer draw, batched the same way as :meth:`next`."""
+        i = self._u32_index
+        if i >= len(self._u32_values):
+            self._refill_u32()
+            i = 0
+        self._u32_index = i + 1
+        return self._u32_values[i]
+
+    def _refill(self):
+        if numpy is None:
+            rand = self._rng.random
+            self._values = [rand() for _ in range(self.BATCH)]
+        else:
+            self._values = self._rng.random(self.BATCH).tolist()
+
+    def _refill_u32(self):
+        if numpy is None:
+            getrandbits = self._rng.getrandbits
+            self._u32_values = [getrandbits(32) for _ in range(self.BATCH)]
+        else:
+            self._u32_values = self._rng.integers(
+                0, 1 << 32, self.BATCH, dtype=numpy.uint32
+            ).tolist()
+
+    def _refill_gauss(self):
+        if numpy is None:
+            gauss = self._rng.gauss
+            self._gauss_values = [gauss(0.0, 1.0) for _ in range(self.BATCH)]
+        else:
+            self._gauss_values = self._rng.standard_normal(self.BATCH).tolist()
+
+
+def pack_sockaddr(addr):
+    """Encode an ``(ip, port)`` tuple as a ``struct sockaddr_in``.
+
+    Family is host-endian, port/addr are network-endian, then 8 bytes
+    of zero padding.
+    """
+    ip, port = addr
+    return struct.pack(
+        "=H2s4s8x", socket.AF_INET, struct.pack("!H", port), socket.inet_aton(ip)
+    )
+
+
+# Direction tags for entries in the shared delay queue.
+C2S = 0  # client -> server
+S2C = 1  # server -> client
+
+
+class PacketDelayQueue:
+    """Holds packets for both directions until their release deadline.
+
+    Packets sit in a min-heap ordered by ``(deadline, seq)``; the event
+    loop's select() timeout is derived from the head deadline, so there
+    is no polling loop and no polling-interval jitter on top of the
+    simulated latency.  The sequence tiebreaker keeps packets with
+    equal deadlines in FIFO order.  Entries carry a direction tag so
+    one heap (one timer source, one dispatcher) serves both traffic
+    directions.
+
+    Not thread-safe -- and deliberately so.  Everything that touches
+    the queue (receive drains, deadline checks, dispatch) runs on the
+    single event-loop thread, so the lock and condition variable the
+    queue grew up with were pure overhead: every add_batch and
+    pop_ready paid an uncontended acquire/release and a notify with
+    nobody waiting.
+    """
+
+    # Upper bound on queued packets.  High latency times a flood
+    # (10 s at line rate) would otherwise grow the heap without limit;
+    # past the cap the oldest queued packet is evicted, which is also
+    # what an overrun router queue would do.  65536 MTU-sized packets
+    # is ~128 MB of payload, far beyond any realistic game burst.
+    DEFAULT_MAX_QUEUED = 65536
+
+    def __init__(self, preserve_order=False, max_queued=DEFAULT_MAX_QUEUED):
+        self._heap = []
+        self._seq = itertools.count()
+        self._preserve_order = preserve_order
+        self._max_queued = max_queued
+        self._last_deadline = [0, 0]  # per direction
+
+    def add_packet(self, direction, data, dest, delay_ns):
+        """Queue ``data`` for delivery to ``dest`` after ``delay_ns`` ns.
+
+        Deadlines are integer nanoseconds on the monotonic clock:
+        immune to wall-clock steps (NTP slew) and free of float
+        rounding as uptime grows.  Returns the payloads evicted to
+        stay under ``max_queued`` (normally empty) so the caller can
+        recycle their buffers.
+        """
+        deadline = time.monotonic_ns() + delay_ns
+        if self._preserve_order:
+            deadline = max(deadline, self._last_deadline[direction])
+            self._last_deadline[direction] = deadline
+        evicted = ()
+        if len(self._heap) >= self._max_queued:
+            evicted = (heapq.heappop(self._heap)[3],)
+        heapq.heappush(
+            self._heap, (deadline, next(self._seq), direction, data, dest)
+        )
+        return evicted
+
+    def add_batch(self, direction, packets):
+        """Queue many ``(data, dest, delay_ns)`` triples at once.
+
+        Returns evicted payloads exactly like :meth:`add_packet`.
+        """
+        now = time.monotonic_ns()
+        heap = self._heap
+        push = heapq.heappush
+        pop = heapq.heappop
+        seq = self._seq
+        preserve = self._preserve_order
+        max_queued = self._max_queued
+        evicted = None
+        for data, dest, delay_ns in packets:
+            deadline = now + delay_ns
+            if preserve:
+                deadline = max(deadline, self._last_deadline[direction])
+                self._last_deadline[direction] = deadline
+            if len(heap) >= max_queued:
+                if evicted is None:
+                    evicted = []
+                evicted.append(pop(heap)[3])
+            push(heap, (deadline, next(seq), direction, data, dest))
+        return evicted or ()
+
+    def seconds_until_ready(self, max_wait):
+        """Seconds until the head packet is due, capped at ``max_wait``.
+
+        The event loop uses this as its select() timeout, so the one
+        kernel wait covers both socket readiness and the next release
+        deadline.
+        """
+        if not self._heap:
+            return max_wait
+        delta = self._heap[0][0] - time.monotonic_ns()
+        if delta <= 0:
+            return 0.0
+        return min(delta / 1e9, max_wait)
+
+    def next_deadline_ns(self):
+        """Absolute monotonic-ns deadline of the head packet (0 if empty)."""
+        return self._heap[0][0] if self._heap else 0
+
+    def pop_ready(self):
+        """Pop and return every packet whose deadline has passed."""
+        heap = self._heap
+        now = time.monotonic_ns()
+        if not heap or heap[0][0] > now:
+            return []
+        ready = []
+        pop = heapq.heappop
+        while heap and heap[0][0] <= now:
+            _, _, direction, data, dest = pop(heap)
+            ready.append((direction, data, dest))
+        return ready
+
+
+class PacketFifoQueue:
+    """Drop-in for :class:`PacketDelayQueue` when deadlines are monotone.
+
+    With no jitter and no reorder, every packet gets the same constant
+    delay, so enqueue order *is* deadline order: the heap's O(log n)
+    push/pop and per-entry sequence number buy nothing.  A deque gives
+    O(1) appends and pops, and the ready check reads only the head
+    entry's deadline.  Interface, bounding and eviction behaviour match
+    PacketDelayQueue; the proxy picks the queue that fits the config at
+    startup.
+    """
+
+    def __init__(self, max_queued=PacketDelayQueue.DEFAULT_MAX_QUEUED):
+        self._queue = collections.deque()
+        self._max_queued = max_queued
+
+    def add_packet(self, direction, data, dest, delay_ns):
+        """Queue one packet; returns evicted payloads (normally empty)."""
+        queue = self._queue
+        evicted = ()
+        if len(queue) >= self._max_queued:
+            evicted = (queue.popleft()[2],)
+        queue.append((time.monotonic_ns() + delay_ns, direction, data, dest))
+        return evicted
+
+    def add_batch(self, direction, packets):
+        """Queue many ``(data, dest, delay_ns)`` triples at once."""
+        queue = self._queue
+        append = queue.append
+        popleft = queue.popleft
+        now = time.monotonic_ns()
+        max_queued = self._max_queued
+        evicted = None
+        for data, dest, delay_ns in packets:
+            if len(queue) >= max_queued:
+                if evicted is None:
+                    evicted = []
+                evicted.append(popleft()[2])
+            append((now + delay_ns, direction, data, dest))
+        return evicted or ()
+
+    def seconds_until_ready(self, max_wait):
+        """Seconds until the head packet is due, capped at ``max_wait``."""
+        if not self._queue:
+            return max_wait
+        delta = self._queue[0][0] - time.monotonic_ns()
+        if delta <= 0:
+            return 0.0
+        return min(delta / 1e9, max_wait)
+
+    def next_deadline_ns(self):
+        """Absolute monotonic-ns deadline of the head packet (0 if empty)."""
+        return self._queue[0][0] if self._queue else 0
+
+    def pop_ready(self):
+        """Pop and return every packet whose deadline has passed."""
+        queue = self._queue
+        now = time.monotonic_ns()
+        ready = []
+        popleft = queue.popleft
+        while queue and queue[0][0] <= now:
+            _, direction, data, dest = popleft()
+            ready.append((direction, data, dest))
+        return ready
+
+
+class FakeLagProxy:
+    """Forwards UDP packets between clients and a remote server, applying
+    the latency/jitter/loss from a :class:`LagConfig` in both directions.
+    """
+
+    PACKET_BUF_SIZE = 2048  # fits any MTU-sized game packet
+    BUF_POOL_MAX = 1024
+    # Kernel buffer size requested for every proxy socket.  The
+    # default ~208 KiB overflows on the first real burst -- the proxy
+    # holds traffic back by design, so both queues run much fuller
+    # than a normal forwarder's -- and those drops would be
+    # indistinguishable from the simulated loss.  The kernel silently
+    # caps this at net.core.rmem_max/wmem_max; raise those sysctls
+    # (e.g. net.core.rmem_max=12582912) to get the full size.
+    SOCKET_BUF_BYTES = 12 * 1024 * 1024
+
+    def __init__(self, listen_addr, remote_addr, config, reuse_port=False):
+        self.listen_addr = listen_addr
+        # Resolve the remote endpoint to a numeric sockaddr once, up
+        # front: per-session connect() then never touches DNS, and a
+        # bad hostname fails at startup instead of on first packet.
+        self.remote_addr = socket.getaddrinfo(
+            remote_addr[0],
+            remote_addr[1],
+            socket.AF_INET,
+            socket.SOCK_DGRAM,
+        )[0][4]
+        self.config = config
+        self.listen_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self._tune_socket(self.listen_sock)
+        if reuse_port:
+            # Several proxy processes bind the same port and the kernel
+            # hashes each client 4-tuple to exactly one of them, so a
+            # given client's packets always land in the same worker.
+            self.listen_sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        self.listen_sock.bind(listen_addr)
+        self.listen_sock.setblocking(False)
+        # client address -> upstream socket used to talk to the server
+        # on that client's behalf.  The reverse mapping rides along in
+        # each selector key's data slot, so a readable upstream socket
+        # resolves to its client with no lookup at all.
+        self.client_sessions = {}
+        # client address -> pre-packed struct sockaddr_in, filled when
+        # the session is created so the mmsg send path never re-encodes
+        # an address per packet.
+        self._client_sockaddrs = {}
+        self._selector = selectors.DefaultSelector()
+        self._selector.register(self.listen_sock, selectors.EVENT_READ)
+        # Release timing: epoll_wait rounds its timeout up to whole
+        # milliseconds, which puts up to 1 ms of slop on every packet
+        # release.  A timerfd armed on the same CLOCK_MONOTONIC the
+        # deadlines use wakes the loop with nanosecond resolution
+        # instead; the select() timeout then only backstops shutdown.
+        self._timer_fd = None
+        self._timer_spec = None
+        if _libc is not None and hasattr(_libc, "timerfd_create"):
+            fd = _libc.timerfd_create(_CLOCK_MONOTONIC, _TFD_NONBLOCK)
+            if fd >= 0:
+                self._timer_fd = fd
+                self._timer_spec = _itimerspec()
+                self._selector.register(fd, selectors.EVENT_READ)
+        if config.jitter_ms == 0 and config.reorder == 0:
+            # A constant delay means packets become due in enqueue
+            # order, so the plain FIFO queue can replace the heap.
+            self._delay_queue = PacketFifoQueue()
+        else:
+            self._delay_queue = PacketDelayQueue(
+                preserve_order=config.preserve_order
+            )
+        self._rand = RandomBatch()  # used from the receive loop only
+        self._ge_state = 0  # 0 = Good, 1 = Bad
+        self._cache_config()
+        # Batched syscall helpers (Linux only; None means fall back to
+        # one-datagram recvfrom/sendto).
+        if _libc is not None:
+            self._listen_rx = MmsgBatch(with_names=True)
+            self._upstream_rx = MmsgBatch(with_names=False)
+            self._listen_tx = MmsgBatch(with_names=True)
+            self._upstream_tx = MmsgBatch(with_names=False)
+        else:
+            self._listen_rx = self._upstream_rx = None
+            self._listen_tx = self._upstream_tx = None
+        # Scratch buffer for the non-mmsg receive path: recv into this
+        # and copy out only the bytes actually received, instead of
+        # letting recvfrom allocate 65535 bytes per call.
+        self._recv_view = memoryview(bytearray(65535))
+        # Recycled payload buffers.  Queued packets live in MTU-sized
+        # bytearrays drawn from here and returned after send, so steady
+        # traffic stops churning the allocator; oversized datagrams get
+        # an exact-size buffer that is simply not recycled.
+        self._buf_pool = collections.deque(
+            bytearray(self.PACKET_BUF_SIZE) for _ in range(64)
+        )
+        self._running = False
+        self._threads = []
+        self._stopped = threading.Event()
+        # Drops are only counted on the hot path; a summary line goes
+        # out periodically from the receive loop instead of one print
+        # (plus stdout lock and possible blocking write) per packet.
+        self._drop_count = 0
+        self._stats_interval = 5.0
+        self._last_stats = time.monotonic()
+        # Token bucket for warning output.  If the remote goes down
+        # mid-run, every queued packet can fail to send at once; a
+        # warning per failure would turn the event loop into a logging
+        # loop.  Past the budget, failures are counted and summarized
+        # with the periodic stats instead.
+        self._warn_tokens = float(self.WARN_PER_SEC)
+        self._warn_refill = time.monotonic()
+        self._warns_suppressed = 0
+        self._overflow_count = 0
+
+    # Microseconds the kernel busy-polls the NIC driver before parking
+    # the socket on an interrupt; shaves interrupt wakeup latency off
+    # UDP ping-pong at the cost of some CPU.  Needs CAP_NET_ADMIN (or
+    # net.core.busy_read); silently skipped without it.
+    BUSY_POLL_USEC = 50
+    # Max warnings logged per second; the rest are counted and
+    # summarized (see _warn).
+    WARN_PER_SEC = 10
+
+    def _tune_socket(self, sock):
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, self.SOCKET_BUF_BYTES)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, self.SOCKET_BUF_BYTES)
+        if sys.platform != "linux":
+            return
+        try:
+            sock.setsockopt(socket.SOL_SOCKET, _SO_BUSY_POLL, self.BUSY_POLL_USEC)
+        except OSError:
+            pass  # unprivileged; interrupt-driven receive still works
+        try:
+            # Set DF and skip kernel fragmentation work per datagram.
+            # Game packets stay under the MTU by design, so the
+            # EMSGSIZE an oversized send would now get is a bug signal,
+            # not a regression.
+            sock.setsockopt(socket.IPPROTO_IP, _IP_MTU_DISCOVER, _IP_PMTUDISC_DO)
+        except OSError:
+            pass
+
+    # -- per-packet decisions --------------------------------------
+
+    def _cache_config(self):
+        """Copy config fields into flat instance attributes.
+
+        The per-packet samplers then read one attribute instead of
+        going through ``self.config`` plus a dataclass field each time.
+        Call again if ``self.config`` is ever mutated at runtime.
+        """
+        cfg = self.config
+        self._latency_ns = int(cfg.latency_ms * 1e6)
+        self._jitter_half_ns = int(cfg.jitter_ms * 0.5 * 1e6)
+        self._reorder_p = cfg.reorder
+        self._use_ge = cfg.loss_model == "ge"
+        # Loss probabilities as 32-bit integer thresholds: the drop
+        # check becomes one batched getrandbits-style draw against an
+        # int, with no float math and no zero-probability branch (a
+        # threshold of 0 never fires).
+        scale = 1 << 32
+        self._loss_thr = int(cfg.loss * scale)
+        self._ge_p_thr = int(cfg.ge_p * scale)
+        self._ge_r_thr = int(cfg.ge_r * scale)
+        self._ge_good_thr = int(cfg.ge_loss_good * scale)
+        self._ge_bad_thr = int(cfg.ge_loss_bad * scale)
+        if self._use_ge:
+            lossless = cfg.ge_loss_good == 0 and cfg.ge_loss_bad == 0
+        else:
+            lossless = cfg.loss == 0
+        # With nothing to simulate, forward straight from the receive
+        # loop: no RNG, no heap, no handoff to the sender thread.
+        # Useful as a baseline for measuring the proxy's own overhead.
+        self._passthrough = cfg.latency_ms == 0 and cfg.jitter_ms == 0 and lossless
+        # Specialize the per-packet callables for the features actually
+        # in use.  The common "just add ping" run (no reorder, no
+        # jitter, no loss) then pays for a constant return and a
+        # False, not for re-checking every disabled feature on every
+        # packet.  The handlers hoist these bound attributes into
+        # locals, so the specialized variant is what the hot loop calls.
+        if self._reorder_p > 0:
+            self._sample_delay = self._sample_delay_full
+        elif self._jitter_half_ns > 0:
+            self._sample_delay = self._sample_delay_jitter
+        else:
+            self._sample_delay = self._sample_delay_fixed
+        if lossless:
+            self._should_drop = self._never_drop
+        elif self._use_ge:
+            self._should_drop = self._should_drop_ge
+        else:
+            self._should_drop = self._should_drop_iid
+
+    # -- per-packet samplers (one is bound per config, see above) ----
+
+    def _sample_delay_fixed(self):
+        """Delay sampler for pure fixed latency: no RNG draw at all."""
+        return self._latency_ns
+
+    def _sample_delay_jitter(self):
+        """Latency plus jitter, with the reorder branch compiled out."""
+        # Normal jitter truncated at +/- jitter (sigma = jitter/2),
+        # like tc netem's delay distribution: most packets land near
+        # the base latency, uniform jitter spreads them flat.
+        z = self._rand.next_gauss()
+        if z > 2.0:
+            z = 2.0
+        elif z < -2.0:
+            z = -2.0
+        delay = self._latency_ns + int(z * self._jitter_half_ns)
+        return delay if delay > 0 else 0
+
+    def _sample_delay_full(self):
+        """Return the delay for one packet in integer nanoseconds."""
+        if self._rand.next() < self._reorder_p:
+            return 0
+        delay = self._latency_ns
+        if self._jitter_half_ns > 0:
+            z = self._rand.next_gauss()
+            if z > 2.0:
+                z = 2.0
+            elif z < -2.0:
+                z = -2.0
+            delay += int(z * self._jitter_half_ns)
+            if delay < 0:
+                delay = 0
+        return delay
+
+    def _never_drop(self):
+        return False
+
+    def _should_drop_iid(self):
+        return self._rand.next_u32() < self._loss_thr
+
+    def _should_drop_ge(self):
+        # Advance the Markov chain once per packet, then test the
+        # current state's loss probability.
+        if self._ge_state == 0:
+            if self._rand.next_u32() < self._ge_p_thr:
+                self._ge_state = 1
+        elif self._rand.next_u32() < self._ge_r_thr:
+            self._ge_state = 0
+        threshold = self._ge_bad_thr if self._ge_state else self._ge_good_thr
+        return self._rand.next_u32() < threshold
+
+    # -- receive paths ---------------------------------------------
+
+    def _event_loop(self):
+        """The proxy's single thread.
+
+        One select() waits on every socket and on the next delay-queue
+        deadline at the same time; each wakeup drains readable sockets
+        and flushes whatever became due.  No inter-thread handoff, no
+        GIL contention, no lock ever blocks.
+        """
+        selector = self._selector
+        queue = self._delay_queue
+        timer_fd = self._timer_fd
+        armed_deadline = -1
+        while self._running:
+            if timer_fd is not None:
+                # Track the head deadline with the timerfd; re-arm only
+                # when it changes (0 disarms an empty queue).
+                deadline = queue.next_deadline_ns()
+                if deadline != armed_deadline:
+                    self._arm_timer(deadline)
+                    armed_deadline = deadline
+                timeout = 0.5
+            else:
+                timeout = queue.seconds_until_ready(0.5)
+            try:
+                events = selector.select(timeout)
+            except OSError:
+                break
+            for key, _ in events:
+                if key.fileobj is self.listen_sock:
+                    self._drain_listen_sock()
+                elif key.fileobj == timer_fd:
+                    try:
+                        os.read(timer_fd, 8)  # clear the expiration count
+                    except BlockingIOError:
+                        pass
+                else:
+                    self._drain_upstream_sock(key.fileobj, key.data)
+            ready = queue.pop_ready()
+            if ready:
+                self._dispatch_ready(ready)
+            self._maybe_report_stats()
+
+    def _arm_timer(self, deadline_ns):
+        spec = self._timer_spec
+        spec.it_value.tv_sec = deadline_ns // 1_000_000_000
+        spec.it_value.tv_nsec = deadline_ns % 1_000_000_000
+        _libc.timerfd_settime(
+            self._timer_fd, _TFD_TIMER_ABSTIME, ctypes.byref(spec), None
+        )
+
+    def _warn(self, msg, *args):
+        """Rate-limited ``logger.warning``; overflow goes to the stats line."""
+        now = time.monotonic()
+        self._warn_tokens = min(
+            float(self.WARN_PER_SEC),
+            self._warn_tokens + (now - self._warn_refill) * self.WARN_PER_SEC,
+        )
+        self._warn_refill = now
+        if self._warn_tokens >= 1.0:
+            self._warn_tokens -= 1.0
+            logger.warning(msg, *args)
+        else:
+            self._warns_suppressed += 1
+
+    def _maybe_report_stats(self):
+        now = time.monotonic()
+        if now - self._last_stats < self._stats_interval:
+            return
+        self._last_stats = now
+        if self._drop_count:
+            logger.info("dropped %d packets", self._drop_count)
+            self._drop_count = 0
+        if self._overflow_count:
+            logger.info("evicted %d packets (queue overflow)", self._overflow_count)
+            self._overflow_count = 0
+        if self._warns_suppressed:
+            logger.warning(
+                "%d further warnings suppressed", self._warns_suppressed
+            )
+            self._warns_suppressed = 0
+
+    def _drain_listen_sock(self):
+        # Hot path: bind everything touched per packet to locals so the
+        # loop avoids repeated attribute lookups.
+        sock = self.listen_sock
+        rx = self._listen_rx
+        recvfrom_into = sock.recvfrom_into
+        view = self._recv_view
+        should_drop = self._should_drop
+        sample_delay = self._sample_delay
+        add_batch = self._delay_queue.add_batch
+        pending = []
+        while True:
+            if rx is not None:
+                try:
+                    batch = rx.recv(sock.fileno())
+                except OSError:
+                    return
+                if not batch:
+                    return
+                for data, client_addr in batch:
+                    self._handle_client_packet(
+                        data, client_addr, should_drop, sample_delay, pending
+                    )
+            else:
+                # Match the mmsg path's batching: drain up to BATCH
+                # datagrams before taking the queue lock once.  The
+                # scratch buffer is shared, so each datagram is handled
+                # (copied into a pooled buffer or sent) before the next
+                # recv overwrites it.
+                got = 0
+                try:
+                    while got < MmsgBatch.BATCH:
+                        nbytes, client_addr = recvfrom_into(view)
+                        got += 1
+                        self._handle_client_packet(
+                            view[:nbytes],
+                            client_addr,
+                            should_drop,
+                            sample_delay,
+                            pending,
+                        )
+                except (BlockingIOError, InterruptedError):
+                    pass
+                except OSError:
+                    pass
+                if got == 0:
+                    return
+            if pending:
+                evicted = add_batch(C2S, pending)
+                if evicted:
+                    self._handle_evicted(evicted)
+                pending.clear()
+
+    def _handle_client_packet(
+        self, data, client_addr, should_drop, sample_delay, pending
+    ):
+        if client_addr not in self.client_sessions:
+            upstream = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            self._tune_socket(upstream)
+            upstream.setblocking(False)
+            # Connecting lets the kernel cache the route/sockaddr
+            # once, lets us use send()/recv(), and filters out
+            # datagrams from anything but the server.
+            upstream.connect(self.remote_addr)
+            self.client_sessions[client_addr] = upstream
+            self._client_sockaddrs[client_addr] = pack_sockaddr(client_addr)
+            self._selector.register(upstream, selectors.EVENT_READ, client_addr)
+        if self._passthrough:
+            try:
+                self.client_sessions[client_addr].send(data)
+            except OSError as exc:
+                self._warn("passthrough send to server failed: %s", exc)
+            return
+        if should_drop():
+            self._drop_count += 1
+            return
+        pending.append((self._copy_to_buf(data), client_addr, sample_delay()))
+
+    def _copy_to_buf(self, view):
+        """Copy a received datagram into a pooled (or fresh) bytearray."""
+        nbytes = len(view)
+        pool = self._buf_pool
+        if nbytes <= self.PACKET_BUF_SIZE:
+            buf = pool.popleft() if pool else bytearray(self.PACKET_BUF_SIZE)
+        else:
+            buf = bytearray(nbytes)
+        buf[:nbytes] = view
+        return (buf, nbytes)
+
+    def _handle_evicted(self, evicted):
+        """Recycle and count payloads the bounded queue pushed out."""
+        recycle = self._recycle_buf
+        for buf, _ in evicted:
+            recycle(buf)
+        self._overflow_count += len(evicted)
+        self._warn("delay queue full, evicted %d oldest packets", len(evicted))
+
+    def _recycle_buf(self, buf):
+        if len(buf) == self.PACKET_BUF_SIZE and len(self._buf_pool) < self.BUF_POOL_MAX:
+            self._buf_pool.append(buf)
+
+    def _drain_upstream_sock(self, upstream, client_addr):
+        rx = self._upstream_rx
+        recv_into = upstream.recv_into
+        view = self._recv_view
+        should_drop = self._should_drop
+        sample_delay = self._sample_delay
+        add_batch = self._delay_queue.add_batch
+        pending = []
+        handle = self._handle_server_packet
+        while True:
+            if rx is not None:
+                try:
+                    batch = rx.recv(upstream.fileno())
+                except OSError:
+                    return
+                if not batch:
+                    return
+                for data in batch:
+                    handle(data, client_addr, should_drop, sample_delay, pending)
+            else:
+                got = 0
+                try:
+                    while got < MmsgBatch.BATCH:
+                        nbytes = recv_into(view)
+                        got += 1
+                        handle(
+                            view[:nbytes],
+                            client_addr,
+                            should_drop,
+                            sample_delay,
+                            pending,
+                        )
+                except (BlockingIOError, InterruptedError):
+                    pass
+                except OSError:
+                    pass
+                if got == 0:
+                    return
+            if pending:
+                evicted = add_batch(S2C, pending)
+                if evicted:
+                    self._handle_evicted(evicted)
+                pending.clear()
+
+    def _handle_server_packet(
+        self, data, client_addr, should_drop, sample_delay, pending
+    ):
+        if self._passthrough:
+            try:
+                self.listen_sock.sendto(data, client_addr)
+            except OSError as exc:
+                self._warn("passthrough send to client failed: %s", exc)
+            return
+        if should_drop():
+            self._drop_count += 1
+            return
+        pending.append((self._copy_to_buf(data), client_addr, sample_delay()))
+
+    # -- delayed forwarding ----------------------------------------
+
+    def _dispatch_ready(self, ready):
+        """Send a batch of due packets for both directions.
+
+        Server-to-client packets leave through the listen socket (so
+        replies come from the port the client talks to) and are flushed
+        with one sendmmsg per batch.  Client-to-server packets come out
+        of the heap in runs from the same client; each run goes out as
+        one sendmmsg on that client's connected upstream socket.
+        """
+        listen_tx = self._listen_tx
+        upstream_tx = self._upstream_tx
+        try:
+            if listen_tx is None:
+                self._send_ready_fallback(ready)
+                return
+            s2c_batch = []
+            run_addr = None
+            run = []
+            sockaddrs = self._client_sockaddrs
+            for direction, data, dest in ready:
+                if direction == S2C:
+                    packed = sockaddrs.get(dest)
+                    if packed is None:
+                        packed = sockaddrs[dest] = pack_sockaddr(dest)
+                    s2c_batch.append((data, packed))
+                    continue
+                if dest != run_addr:
+                    self._flush_run(upstream_tx, run_addr, run)
+                    run_addr = dest
+                    run = []
+                run.append(data)
+            self._flush_run(upstream_tx, run_addr, run)
+            if s2c_batch:
+                listen_tx.send(self.listen_sock.fileno(), s2c_batch)
+        except OSError as exc:
+            self._warn("delayed send failed: %s", exc)
+        finally:
+            recycle = self._recycle_buf
+            for _, (buf, _), _ in ready:
+                recycle(buf)
+
+    def _send_ready_fallback(self, ready):
+        sendto = self.listen_sock.sendto
+        sessions = self.client_sessions
+        for direction, (buf, nbytes), dest in ready:
+            data = memoryview(buf)[:nbytes]
+            if direction == S2C:
+                sendto(data, dest)
+            else:
+                upstream = sessions.get(dest)
+                if upstream is not None:
+                    upstream.send(data)
+
+    def _flush_run(self, tx, client_addr, run):
+        if not run:
+            return
+        upstream = self.client_sessions.get(client_addr)
+        if upstream is not None:
+            tx.send_connected(upstream.fileno(), run)
+
+    # -- lifecycle -------------------------------------------------
+
+    def start(self):
+        self._running = True
+        thread = threading.Thread(target=self._event_loop, daemon=True)
+        thread.start()
+        self._threads.append(thread)
+
+    def stop(self):
+        self._running = False
+        self._stopped.set()
+        self._selector.close()
+        if self._timer_fd is not None:
+            os.close(self._timer_fd)
+            self._timer_fd = None
+        self.listen_sock.close()
+        for upstream in self.client_sessions.values():
+            upstream.close()
+
+    def run_forever(self):
+        self.start()
+        try:
+            self._stopped.wait()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.stop()
+
+
+def _run_worker(listen_addr, remote_addr, config):
+    """Entry point for one ``--workers`` process."""
+    proxy = FakeLagProxy(listen_addr, remote_addr, config, reuse_port=True)
+    proxy.run_forever()
+
+
+def parse_endpoint(value):
+    """Parse a ``host:port`` string into an address tuple."""
+    host, sep, port = value.rpartition(":")
+    if not sep:
+        raise argparse.ArgumentTypeError(f"expected host:port, got {value!r}")
+    return (host or "0.0.0.0", int(port))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="UDP proxy that adds latency, jitter and packet loss."
+    )
+    parser.add_argument(
+        "--listen",
+        type=parse_endpoint,
+        default=("0.0.0.0", 7777),
+        help="address to accept client packets on (default: 0.0.0.0:7777)",
+    )
+    parser.add_argument(
+        "--remote",
+        type=parse_endpoint,
+        required=True,
+        help="real server address to forward to (host:port)",
+    )
+    parser.add_argument(
+        "--latency",
+        type=float,
+        default=100.0,
+        help="one-way latency to add in milliseconds (default: 100)",
+    )
+    parser.add_argument(
+        "--jitter",
+        type=float,
+        default=0.0,
+        help="max jitter in milliseconds added to/removed from latency",
+    )
+    parser.add_argument(
+        "--loss",
+        type=float,
+        default=0.0,
+        help="packet loss probability in [0, 1]",
+    )
+    parser.add_argument(
+        "--loss-model",
+        choices=("iid", "ge"),
+        default="iid",
+        help="iid: independent per-packet loss; ge: Gilbert-Elliott "
+        "bursty loss (see --ge-* options)",
+    )
+    parser.add_argument(
+        "--ge-p",
+        type=float,
+        default=0.05,
+        help="GE model: Good->Bad transition probability (default: 0.05)",
+    )
+    parser.add_argument(
+        "--ge-r",
+        type=float,
+        default=0.5,
+        help="GE model: Bad->Good transition probability (default: 0.5)",
+    )
+    parser.add_argument(
+        "--ge-loss-good",
+        type=float,
+        default=0.0,
+        help="GE model: drop probability in the Good state (default: 0)",
+    )
+    parser.add_argument(
+        "--ge-loss-bad",
+        type=float,
+        default=1.0,
+        help="GE model: drop probability in the Bad state (default: 1)",
+    )
+    parser.add_argument(
+        "--reorder",
+        type=float,
+        default=0.0,
+        help="probability that a packet skips the delay and overtakes "
+        "in-flight packets (netem-style reordering)",
+    )
+    parser.add_argument(
+        "--preserve-order",
+        action="store_true",
+        help="never let jitter reorder packets: each packet is released "
+        "no earlier than the previous one in its direction",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="number of proxy processes sharing the listen port via "
+        "SO_REUSEPORT; the kernel spreads clients across them "
+        "(default: 1, Linux only)",
+    )
+    args = parser.parse_args(argv)
+
+    config = LagConfig(
+        latency_ms=args.latency,
+        jitter_ms=args.jitter,
+        loss=args.loss,
+        loss_model=args.loss_model,
+        ge_p=args.ge_p,
+        ge_r=args.ge_r,
+        ge_loss_good=args.ge_loss_good,
+        ge_loss_bad=args.ge_loss_bad,
+        reorder=args.reorder,
+        preserve_order=args.preserve_order,
+    )
+    logging.basicConfig(format="%(name)s: %(message)s", level=logging.INFO)
+    workers = "" if args.workers <= 1 else f" workers={args.workers}"
+    logger.info(
+        "%s:%d -> %s:%d (latency=%sms jitter=%sms loss=%.1f%%%s)",
+        args.listen[0],
+        args.listen[1],
+        args.remote[0],
+        args.remote[1],
+        config.latency_ms,
+        config.jitter_ms,
+        config.loss * 100,
+        workers,
+    )
+    if args.workers > 1:
+        if not hasattr(socket, "SO_REUSEPORT"):
+            parser.error("--workers needs SO_REUSEPORT (Linux/BSD only)")
+        processes = [
+            multiprocessing.Process(
+                target=_run_worker,
+                args=(args.listen, args.remote, config),
+                daemon=True,
+            )
+            for _ in range(args.workers)
+        ]
+        for process in processes:
+            process.start()
+        try:
+            for process in processes:
+                process.join()
+        except KeyboardInterrupt:
+            for process in processes:
+                process.terminate()
+        return
+    proxy = FakeLagProxy(args.listen, args.remote, config)
+    proxy.run_forever()
+
+
+if __name__ == "__main__":
+    main()